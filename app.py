@@ -1,11 +1,29 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 from pydantic import BaseModel, Field, ValidationError
 import requests
+import charset_normalizer
 from io import StringIO, BytesIO
 import json
+import hashlib
+import codecs
+import sqlite3
+from contextlib import closing
+import re
+import orjson
+import datetime
+import itertools
+import functools
+from collections import Counter
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
+import xlsxwriter
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from sklearn.cluster import DBSCAN
+from sklearn.decomposition import TruncatedSVD
 from sklearn.preprocessing import normalize
 
 # --- Pydantic Models ---
@@ -21,6 +39,44 @@ class Codebook(BaseModel):
 class ClassificationResult(BaseModel):
     assigned_codes: list[str] = Field(..., description="A list of one or more code labels from the provided codebook that apply to the response. Return an empty list if no codes apply.")
 
+# --- Pydantic models for batched classification output ---
+class IndexedClassificationResult(ClassificationResult):
+    index: int = Field(..., description="The number of the response in the provided numbered list.")
+
+class BatchClassificationResult(BaseModel):
+    results: list[IndexedClassificationResult] = Field(..., description="One entry per numbered response, identified by its index.")
+
+# Number of responses packed into a single classification request
+CLASSIFICATION_BATCH_SIZE = 25
+# Concurrent classification requests; kept within what a local Ollama server handles in parallel
+MAX_CLASSIFICATION_WORKERS = 4
+# Redraw the progress bar every N completed batches rather than after each one
+PROGRESS_UPDATE_EVERY = 5
+# Embeddings are projected down to this many dimensions before clustering
+CLUSTERING_DIMENSIONS = 128
+# Responses within this cosine distance of each other are grouped together
+CLUSTER_COSINE_DISTANCE = 0.3
+# From this many responses on, clustering uses a FAISS HNSW neighbour graph instead of DBSCAN (when faiss is installed)
+FAISS_MIN_RESPONSES = 20000
+# DBSCAN outliers at least this cosine-similar to a cluster centroid reuse that cluster's code
+OUTLIER_SIMILARITY_THRESHOLD = 0.85
+# Outermost {...} span of a model reply, used to strip any prose around the JSON payload
+_JSON_BLOCK_RE = re.compile(r'\{.*\}', re.S)
+# Separator between codes in multi-label results
+_MULTI_LABEL_SEPARATOR_RE = re.compile(r'\s*\|\s*')
+# Byte-order marks of UTF-16/32 text (the UTF-32-LE mark starts with the UTF-16-LE one)
+_WIDE_UNICODE_BOMS = (codecs.BOM_UTF32_BE, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+# pandas' default missing-value markers, passed to polars so both CSV readers agree on what counts as blank
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+# Excel worksheet limits (rows include the header row)
+EXCEL_MAX_ROWS, EXCEL_MAX_COLUMNS = 1048576, 16384
+# SQLite file holding past classifications, keyed by mode, model, codebook context and response
+CLASSIFICATION_CACHE_PATH = ".classify_cache.sqlite3"
+# Keep the model (and its cached prompt prefix) loaded between the many classification calls
+OLLAMA_KEEP_ALIVE = "30m"
+# Classified frames kept in the process-wide results store before the oldest is dropped
+MAX_STORED_RESULTS = 8
+
 # --- Page Configuration ---
 st.set_page_config(page_title="Intelligent Survey Coder", page_icon="🧠", layout="wide")
 
@@ -28,30 +84,216 @@ st.set_page_config(page_title="Intelligent Survey Coder", page_icon="🧠", layo
 def initialize_state():
     for key, value in {
         'api_key': None, 'openai_key': None, 'df': None, 'structured_codebook': None,
-        'classified_df': None, 'question_text': "", 'initial_sample_size': 0
+        'classified_key': None, 'question_text': "", 'initial_sample_size': 0, 'display_cols': None
     }.items():
         if key not in st.session_state: st.session_state[key] = value
 
 initialize_state()
 
 # --- Helper & API Functions ---
+def detect_encoding(uploaded_file, sample_size=65536):
+    # Sniff the encoding from a bounded sample rather than the whole upload
+    sample = uploaded_file.read(sample_size); uploaded_file.seek(0)
+    # A full UTF-16/32 sample already ends on a code-unit boundary (sample_size is a multiple of 4), while cutting
+    # after a b'\n' byte would split one; only byte-oriented encodings get trimmed to the last line break
+    if len(sample) == sample_size and not sample.startswith(_WIDE_UNICODE_BOMS) and b'\n' in sample:
+        sample = sample[:sample.rfind(b'\n') + 1]  # Avoid cutting a multi-byte character in half
+    # Unconstrained detection misreads short Western-European samples (e.g. as mac_latin2), so only weigh
+    # the Unicode encodings against cp1252; anything else keeps the previous latin1 behaviour
+    match = charset_normalizer.from_bytes(sample, cp_isolation=['utf_8', 'utf_16', 'utf_32', 'cp1252']).best()
+    if match is None: return 'latin1'
+    if match.encoding in ('ascii', 'utf_8'): return 'utf-8-sig' if match.bom else 'utf-8'
+    return match.encoding
+
+def _read_csv_with_polars(uploaded_file):
+    # polars parses CSVs multi-threaded; it is optional, and any parse error falls back to pandas
+    try:
+        import polars as pl
+        df = pl.read_csv(uploaded_file, encoding='utf8', infer_schema_length=10000, null_values=CSV_NA_VALUES).to_pandas()
+        # polars names blank and repeated headers '' and 'a_duplicated_0'; take pandas' names ('Unnamed: 1', 'a.1')
+        # from a header-only parse so column names do not depend on which reader ran
+        uploaded_file.seek(0)
+        header = pd.read_csv(uploaded_file, encoding='utf-8', nrows=0).columns
+        if len(header) != len(df.columns): raise ValueError("header mismatch")
+        df.columns = header
+        uploaded_file.seek(0)
+        return df
+    except Exception:
+        uploaded_file.seek(0)
+        return None
+
+def read_csv_upload(uploaded_file):
+    encoding = detect_encoding(uploaded_file)
+    if encoding == 'utf-8':
+        df = _read_csv_with_polars(uploaded_file)
+        if df is not None: return df
+    try:
+        return pd.read_csv(uploaded_file, encoding=encoding)
+    except UnicodeDecodeError:
+        # The sample looked like one encoding but later bytes disagree; latin1 decodes any byte sequence
+        uploaded_file.seek(0)
+        return pd.read_csv(uploaded_file, encoding='latin1')
+
 def load_data(uploaded_file):
     try:
-        if uploaded_file.name.endswith('.csv'): return pd.read_csv(uploaded_file, encoding='latin1')
+        if uploaded_file.name.endswith('.csv'): return read_csv_upload(uploaded_file)
         elif uploaded_file.name.endswith(('.xls', '.xlsx')): return pd.read_excel(uploaded_file)
     except Exception as e: st.error(f"Error loading file: {e}"); return None
 
-@st.cache_data
-def convert_df_to_downloadable(df, format="CSV"):
-    if format == "CSV": return df.to_csv(index=False).encode('utf-8')
+def pandas_content_bytes(obj) -> bytes:
+    # Exact content key: row hashes alone ignore column names and dtypes, so the shape and those are included too
+    header = (obj.shape, list(obj.dtypes.items())) if isinstance(obj, pd.DataFrame) else (obj.shape, obj.name, obj.dtype)
+    return repr(header).encode() + pd.util.hash_pandas_object(obj, index=False).values.tobytes()
+
+PANDAS_HASH_FUNCS = {pd.DataFrame: pandas_content_bytes, pd.Series: pandas_content_bytes}
+
+@st.cache_data(hash_funcs=PANDAS_HASH_FUNCS)
+def compute_valid_text_columns(df: pd.DataFrame) -> list[str]:
+    text_df = df.select_dtypes(include=['object', 'string'])
+    if text_df.columns.empty:
+        return []
+    # Count distinct non-empty values per text column (nunique ignores the blanks mapped to NA)
+    counts = text_df.apply(lambda s: s.dropna().astype('string').str.strip().replace('', pd.NA).nunique())
+    return counts[counts > 50].index.tolist()
+
+@st.cache_data(hash_funcs=PANDAS_HASH_FUNCS)
+def get_unique_responses(df: pd.DataFrame, column: str) -> list:
+    return df[column].dropna().unique().tolist()
+
+@st.cache_data(hash_funcs=PANDAS_HASH_FUNCS)
+def compute_code_frequencies(codes: pd.Series, multilabel: bool) -> pd.DataFrame:
+    freq_df = codes.dropna()
+    # Check if we need to split multi-label strings
+    if multilabel:
+        # Split each distinct label string once and weight its codes by how often it occurs, without exploding rows
+        counter = Counter()
+        for labels, count in freq_df.value_counts(sort=False).items():
+            if not count: continue  # Unused categories of a categorical Series
+            for code in _MULTI_LABEL_SEPARATOR_RE.split(str(labels)): counter[code] += count
+        freq_counts = pd.DataFrame(counter.most_common(), columns=['Code', 'Frequency'])
     else:
+        freq_counts = freq_df.value_counts().reset_index()
+        freq_counts.columns = ['Code', 'Frequency']
+    # Kept numeric (0-100); formatting is left to the table's column config
+    pct = freq_counts['Frequency'].to_numpy(dtype=np.float64)
+    freq_counts['Percentage'] = pct * (100.0 / pct.sum()) if pct.size else pct
+    return freq_counts
+
+def hash_dataframe(df: pd.DataFrame) -> str:
+    return hashlib.sha256(pandas_content_bytes(df)).hexdigest()
+
+# Classified frames live in one process-wide store instead of being copied into each session; sessions keep only the key
+@st.cache_resource
+def _classified_store():
+    return {}
+
+def store_classified_df(df: pd.DataFrame) -> str:
+    store, key = _classified_store(), hash_dataframe(df)
+    store.pop(key, None); store[key] = df
+    while len(store) > MAX_STORED_RESULTS: store.pop(next(iter(store)), None)
+    return key
+
+def get_classified_df():
+    return _classified_store().get(st.session_state.classified_key)
+
+# Non-null assigned codes as a categorical, derived once per stored result and reused by every rerun
+@st.cache_resource(max_entries=MAX_STORED_RESULTS, show_spinner=False)
+def get_nonnull_codes(key: str, _df: pd.DataFrame) -> pd.Series:
+    return _df['Assigned Code'].dropna().astype('category')
+
+# Arrow conversion of the results preview, done once per result, column selection and row count rather than on every rerun
+@st.cache_resource(max_entries=16, show_spinner=False)
+def get_preview_table(key: str, columns: tuple, rows: int, _df: pd.DataFrame):
+    preview = _df.head(rows)
+    try:
+        return pa.Table.from_pandas(preview, preserve_index=False)
+    except pa.ArrowException:
+        return preview  # Mixed-type object columns; let st.dataframe apply its own conversion
+
+# Downloads are serialized in the background as soon as results exist, so the click rarely waits on them
+@st.cache_resource
+def _download_executor():
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource
+def _download_futures():
+    return {}
+
+def schedule_downloads(key: str, df: pd.DataFrame):
+    futures, stored = _download_futures(), _classified_store()
+    for format in ("CSV", "Excel"):
+        if (key, format) not in futures: futures[(key, format)] = _download_executor().submit(convert_df_to_downloadable, df, format)
+    # Forget serialized bytes of frames that have left the results store
+    for stale in [entry for entry in list(futures) if entry[0] not in stored]: futures.pop(stale, None)
+
+def get_download_bytes(key: str, format: str, df: pd.DataFrame):
+    futures = _download_futures()
+    future = futures.get((key, format))
+    if future is None:  # Only after the resource caches were cleared; serialize again and keep the result
+        future = futures[(key, format)] = _download_executor().submit(convert_df_to_downloadable, df, format)
+    return future.result()
+
+def convert_df_to_downloadable(df, format="CSV"):
+    if format == "CSV": return _df_to_csv_bytes(df)
+    else: return _df_to_excel_bytes(df)
+
+def _df_to_csv_bytes(df):
+    output = BytesIO()
+    try:
+        # Arrow's vectorized C++ writer avoids pandas' per-row Python formatting
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), output)
+    except pa.ArrowException:
+        # Mixed-type object columns cannot be converted to Arrow; use the pandas writer for those
         output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer: df.to_excel(writer, index=False, sheet_name='Sheet1')
-        return output.getvalue()
+        df.to_csv(output, index=False, encoding='utf-8')
+    return output.getvalue()
+
+def _excel_cell(value):
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)): return None
+    if isinstance(value, np.generic): value = value.item()  # e.g. numpy ints from nullable Int64 columns
+    if isinstance(value, (str, int, float, datetime.date, datetime.time, datetime.timedelta)): return value
+    return str(value)
+
+def _df_to_excel_bytes(df):
+    # Neither writer fails on oversized frames (xlsxwriter's write_row just returns -1), so check up front
+    if len(df) + 1 > EXCEL_MAX_ROWS or len(df.columns) > EXCEL_MAX_COLUMNS:
+        raise ValueError(f"This sheet is too large! Your sheet size is: {len(df) + 1}, {len(df.columns)} Max sheet size is: {EXCEL_MAX_ROWS}, {EXCEL_MAX_COLUMNS}")
+    # rustpy-xlsxwriter writes the sheet from Rust, far faster than per-cell Python writes. It silently leaves other
+    # pandas extension dtypes (categorical, nullable Int64, tz-aware datetimes...) blank instead of raising, so only
+    # plain NumPy and string columns (pandas' default for text read from CSV/Excel) go through it; anything else
+    # uses the xlsxwriter writer. Categorical columns (e.g. single-label Assigned Code) are cheap to decode first.
+    categorical = df.select_dtypes('category').columns
+    if len(categorical): df = df.astype({col: object for col in categorical})
+    if all(isinstance(dtype, (np.dtype, pd.StringDtype)) for dtype in df.dtypes):
+        try:
+            from rustpy_xlsxwriter import FastExcel
+            output = BytesIO()
+            FastExcel(output).sheet('Sheet1', df).save()
+            return output.getvalue()
+        except (ImportError, ValueError, TypeError):
+            pass  # Not installed, or a value it rejects; the xlsxwriter path handles both
+    return _df_to_excel_bytes_xlsxwriter(df)
+
+def _df_to_excel_bytes_xlsxwriter(df):
+    # constant_memory flushes each row to a temp file once the next row starts, so RAM stays O(columns).
+    # It requires strict row order, which df.to_excel (column-by-column) breaks, hence the direct writer.
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss', 'remove_timezone': True})
+    worksheet = workbook.add_worksheet('Sheet1')
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], workbook.add_format({'bold': True}))
+    for row_num, row in enumerate(df.itertuples(index=False, name=None), 1):
+        worksheet.write_row(row_num, 0, [_excel_cell(value) for value in row])
+    workbook.close()
+    return output.getvalue()
 
 def reconstruct_codebook_text(codebook_obj: Codebook):
     if not codebook_obj or not codebook_obj.codes: return ""
-    return "\n".join([f"- Code: {item.code}\n  Description: {item.description}" for item in codebook_obj.codes]).strip()
+    # The (code, description) tuple doubles as the fingerprint, so edits produce a new cache entry
+    return _codebook_text(tuple((item.code, item.description) for item in codebook_obj.codes))
+
+@functools.lru_cache(maxsize=8)
+def _codebook_text(codes: tuple) -> str:
+    return "\n".join([f"- Code: {code}\n  Description: {description}" for code, description in codes]).strip()
 
 def generate_structured_codebook_prompt(question, examples):
     example_str = "\n".join([f'"{ex}"' for ex in examples])
@@ -70,64 +312,181 @@ def create_merge_prompt(codebook1_json: str, codebook2_json: str, user_instructi
         prompt += f"""\n\n**CRITICAL USER INSTRUCTIONS:**\nYou MUST follow these instructions. They override general guidance.\n---\n{user_instructions}\n---"""
     return prompt
 
-def classify_response_prompt(question, response, codebook_text):
+# Static part of every classification prompt, passed to call_ollama_api as cache_prefix
+def classification_context(question, codebook_text):
+    return f"""**Question:** "{question}" **Codebook:**\n---\n{codebook_text}\n---"""
+
+def classify_response_prompt(response):
     return f"""Classify the response based on the codebook. Choose the single best code label.
-    **Question:** "{question}" **Codebook:**\n---\n{codebook_text}\n--- **Response:** "{response}"
+    **Response:** "{response}"
     **Your output must be ONLY the code label.**"""
 
 # --- NEW: Prompt for multi-label classification ---
-def classify_response_prompt_multi(question, response, codebook_text):
+def classify_response_prompt_multi(response):
     return f"""Analyze the response and identify ALL themes from the codebook that are present.
-    **Question:** "{question}" **Codebook:**\n---\n{codebook_text}\n--- **Response:** "{response}"
+    **Response:** "{response}"
     **Instructions:** Return a list of all applicable code labels. If no codes apply, return an empty list."""
 
-def get_embeddings(texts: list[str], unused_param: str = None, model="sentence-transformers"):
-    # Use local sentence-transformers for embeddings
+def classify_batch_prompt(responses, multilabel=False):
+    numbered = "\n".join([f'{i}. "{response}"' for i, response in enumerate(responses, 1)])
+    task = "identify ALL themes from the codebook that are present in it" if multilabel else "choose the single best code label"
+    return f"""Classify each numbered response based on the codebook. For each response, {task}.
+    **Responses:**\n{numbered}
+    **Instructions:** Return exactly one result per response, using its number as `index` and the applicable code labels as `assigned_codes`. If no codes apply, return an empty list."""
+
+def canonicalize_response(text: str) -> str:
+    # Responses that differ only by whitespace or letter case share one classification
+    return " ".join(text.split()).casefold()
+
+def chunked(items, size):
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+@st.cache_resource
+def get_http_session():
+    # One pooled HTTP session per process, so calls reuse keep-alive connections instead of reconnecting
+    return requests.Session()
+
+@functools.lru_cache(maxsize=None)
+def get_schema_json(pydantic_model):
+    return json.dumps(pydantic_model.model_json_schema())
+
+@st.cache_resource(show_spinner=False)
+def _get_encoder():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer('all-MiniLM-L6-v2')
+
+def get_embeddings(texts: list[str]):
+    # Use local sentence-transformers for embeddings; vectors come back unit-normalized
     try:
-        from sentence_transformers import SentenceTransformer
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-        embeddings = model.encode(texts)
-        return [emb.tolist() for emb in embeddings]
+        encoder = _get_encoder()
     except ImportError:
-        st.warning("sentence-transformers not installed. Using random embeddings.")
-        # Fallback to random embeddings
-        import numpy as np
-        np.random.seed(42)
-        return [np.random.rand(384).tolist() for _ in texts]
+        st.warning("sentence-transformers not installed. Classifying without semantic clustering.")
+        return None
+    embeddings = encoder.encode(texts, batch_size=128, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    # float32 halves memory versus float64 and keeps sklearn's neighbour search on single-precision lanes
+    return np.asarray(embeddings, dtype=np.float32)
+
+def reduce_embeddings(embeddings, n_components=CLUSTERING_DIMENSIONS):
+    # Uncentred projection onto the top singular directions approximates the original dot products (PCA's mean-centring
+    # would change the cosine geometry the thresholds are tuned on). With no more rows than components the rows
+    # already span at most n_components dimensions, so the projection would be exact and is skipped.
+    if embeddings.shape[1] <= n_components or len(embeddings) <= n_components:
+        return embeddings
+    reduced = TruncatedSVD(n_components=n_components, algorithm='randomized', random_state=0).fit_transform(embeddings)
+    # Re-normalize so the cosine/Euclidean equivalence used by the clustering still holds
+    return normalize(reduced).astype(np.float32, copy=False)
+
+def _cluster_with_hnsw(embeddings, faiss, n_neighbors=10):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    n = len(embeddings)
+    index = faiss.IndexHNSWFlat(embeddings.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+    index.add(np.ascontiguousarray(embeddings))
+    similarities, neighbors = index.search(np.ascontiguousarray(embeddings), n_neighbors)
+    # Link each response to its approximate neighbours within the distance threshold and take connected components
+    rows = np.repeat(np.arange(n), neighbors.shape[1]); cols = neighbors.ravel()
+    keep = (similarities.ravel() > 1 - CLUSTER_COSINE_DISTANCE) & (cols >= 0) & (cols != rows)
+    graph = coo_matrix((np.ones(keep.sum(), dtype=np.int8), (rows[keep], cols[keep])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    # Singleton components are outliers, matching DBSCAN's -1 label
+    labels[np.bincount(labels)[labels] == 1] = -1
+    return labels
+
+def cluster_embeddings(embeddings):
+    if len(embeddings) >= FAISS_MIN_RESPONSES:
+        try:
+            import faiss
+            return _cluster_with_hnsw(embeddings, faiss)
+        except ImportError:
+            pass
+    # Embeddings are unit-normalized, so a cosine distance d equals a Euclidean distance of sqrt(2 * d)
+    db = DBSCAN(eps=np.sqrt(2 * CLUSTER_COSINE_DISTANCE), min_samples=2, metric='euclidean', algorithm='ball_tree', n_jobs=-1).fit(embeddings)
+    return db.labels_
+
+def attach_outliers_to_clusters(embeddings, labels, threshold=OUTLIER_SIMILARITY_THRESHOLD, chunk_size=4096):
+    labels = np.array(labels, copy=True)
+    clustered = labels != -1
+    outlier_idx = np.flatnonzero(~clustered)
+    if outlier_idx.size == 0 or not clustered.any():
+        return labels
+    # Per-cluster centroids of the unit-normalized embeddings, renormalized so dot products are cosine similarities
+    cluster_ids, inverse = np.unique(labels[clustered], return_inverse=True)
+    centroids = np.zeros((cluster_ids.size, embeddings.shape[1]), dtype=embeddings.dtype)
+    np.add.at(centroids, inverse, embeddings[clustered])
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    # Score outliers in chunks to bound the size of the similarity matrix
+    for start in range(0, outlier_idx.size, chunk_size):
+        idx = outlier_idx[start:start + chunk_size]
+        similarities = embeddings[idx] @ centroids.T
+        best = similarities.argmax(axis=1)
+        close = similarities[np.arange(idx.size), best] > threshold
+        labels[idx[close]] = cluster_ids[best[close]]
+    return labels
+
+# --- Persistent classification cache ---
+def classification_cache_keys(responses, mode, model, context):
+    # Hashing the full prompt context means any codebook or question edit invalidates old entries
+    prefix = f"{mode}\x1f{model}\x1f{hashlib.sha256(context.encode('utf-8')).hexdigest()}\x1f"
+    return {response: hashlib.sha256((prefix + response).encode('utf-8')).hexdigest() for response in responses}
+
+def _open_classification_cache():
+    connection = sqlite3.connect(CLASSIFICATION_CACHE_PATH)
+    connection.execute("CREATE TABLE IF NOT EXISTS classifications (key TEXT PRIMARY KEY, assigned_code TEXT NOT NULL)")
+    return connection
+
+def load_cached_classifications(keys):
+    found = {}
+    try:
+        with closing(_open_classification_cache()) as connection:
+            # Stay under SQLite's bound-parameter limit
+            for batch in chunked(keys, 500):
+                placeholders = ",".join("?" * len(batch))
+                found.update(connection.execute(f"SELECT key, assigned_code FROM classifications WHERE key IN ({placeholders})", batch))
+    except sqlite3.Error as e:
+        st.warning(f"Classification cache unavailable: {e}")
+    return found
+
+def store_cached_classifications(entries: dict):
+    try:
+        with closing(_open_classification_cache()) as connection, connection:
+            connection.executemany("INSERT OR REPLACE INTO classifications (key, assigned_code) VALUES (?, ?)", entries.items())
+    except sqlite3.Error as e:
+        st.warning(f"Could not update classification cache: {e}")
 
-def call_ollama_api(unused_api_key, system_prompt, user_prompt, model="qwen2.5:7b", pydantic_model=None):
+def call_ollama_api(unused_api_key, system_prompt, user_prompt, model="qwen2.5:7b", pydantic_model=None, cache_prefix=None):
     try:
         # Ollama API endpoint (default local installation)
         url = "http://localhost:11434/api/generate"
         
-        # Combine system and user prompts
-        full_prompt = f"System: {system_prompt}\n\nUser: {user_prompt}"
+        # Combine system and user prompts. Static content (system prompt and optional cache_prefix) comes
+        # first so Ollama can reuse its KV cache for the shared prefix; only the user prompt varies per call.
+        static_prompt = f"System: {system_prompt}\n\n{cache_prefix}" if cache_prefix else f"System: {system_prompt}"
+        full_prompt = f"{static_prompt}\n\nUser: {user_prompt}"
         
         if pydantic_model:
             # Request JSON format for structured output
-            json_prompt = f"{full_prompt}\n\nPlease respond with a valid JSON object that matches this schema: {pydantic_model.model_json_schema()}"
+            json_prompt = f"{full_prompt}\n\nPlease respond with a valid JSON object that matches this schema: {get_schema_json(pydantic_model)}"
             
             payload = {
                 "model": model,
                 "prompt": json_prompt,
                 "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
                 "options": {
                     "temperature": 0.0,
                     "num_predict": 4000
                 }
             }
             
-            response = requests.post(url, json=payload)
+            response = get_http_session().post(url, json=payload)
             if response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 try:
-                    json_content = result["response"].strip()
                     # Extract JSON from response if it contains other text
-                    if '{' in json_content:
-                        start = json_content.find('{')
-                        end = json_content.rfind('}') + 1
-                        json_content = json_content[start:end]
-                    data = json.loads(json_content)
+                    json_content = _extract_json_block(result["response"].strip())
+                    data = orjson.loads(json_content)
                     return pydantic_model.model_validate(data)
                 except Exception as e:
                     st.error(f"Failed to parse structured response: {e}")
@@ -140,15 +499,16 @@ def call_ollama_api(unused_api_key, system_prompt, user_prompt, model="qwen2.5:7
                 "model": model,
                 "prompt": full_prompt,
                 "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
                 "options": {
                     "temperature": 0.0,
                     "num_predict": 4000
                 }
             }
             
-            response = requests.post(url, json=payload)
+            response = get_http_session().post(url, json=payload)
             if response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 return result["response"].strip()
             else:
                 st.error(f"Ollama API error: {response.status_code}")
@@ -181,59 +541,50 @@ def codebook_to_csv_bytes(codebook_obj: Codebook):
         st.error(f"Failed to serialize codebook to CSV: {e}")
         return None
 
+def _parse_examples_cell(cell):
+    if isinstance(cell, (list, tuple)):
+        return [str(x) for x in cell]
+    if not isinstance(cell, str):
+        return []
+    try:
+        parsed = orjson.loads(cell)
+        return [str(x) for x in parsed] if isinstance(parsed, list) else [str(parsed)]
+    except json.JSONDecodeError:
+        for sep in ['|', ';', '\n']:
+            if sep in cell:
+                examples_list = [s.strip() for s in cell.split(sep) if s.strip()]
+                if examples_list:
+                    return examples_list
+                break
+        return [cell.strip()] if cell.strip() else []
+
 def parse_uploaded_codebook(uploaded_file):
     try:
         name = uploaded_file.name.lower()
         if name.endswith('.json'):
-            data = json.load(uploaded_file)
+            data = orjson.loads(uploaded_file.read())
             return Codebook.model_validate(data)
         elif name.endswith('.csv'):
-            try:
-                df = pd.read_csv(uploaded_file, encoding='utf-8')
-            except Exception:
-                uploaded_file.seek(0)
-                df = pd.read_csv(uploaded_file, encoding='latin1')
+            df = read_csv_upload(uploaded_file)
             if df is None or df.empty:
                 return None
             normalized_map = {str(col).strip().lower(): col for col in df.columns}
             code_col = normalized_map.get('code') or normalized_map.get('label') or list(df.columns)[0]
             desc_col = normalized_map.get('description') or (list(df.columns)[1] if len(df.columns) > 1 else None)
             examples_col = normalized_map.get('examples')
-            codes = []
-            for _, row in df.iterrows():
-                code_val = row.get(code_col)
-                if pd.isna(code_val):
-                    continue
-                code_text = str(code_val).strip()
-                if not code_text:
-                    continue
-                desc_text = ""
-                if desc_col and desc_col in df.columns:
-                    desc_val = row.get(desc_col)
-                    if not pd.isna(desc_val):
-                        desc_text = str(desc_val).strip()
-                examples_list = []
-                if examples_col and examples_col in df.columns:
-                    cell = row.get(examples_col)
-                    if not pd.isna(cell):
-                        if isinstance(cell, str):
-                            try:
-                                parsed = json.loads(cell)
-                                if isinstance(parsed, list):
-                                    examples_list = [str(x) for x in parsed]
-                                else:
-                                    examples_list = [str(parsed)]
-                            except json.JSONDecodeError:
-                                for sep in ['|', ';', '\n']:
-                                    if sep in cell:
-                                        examples_list = [s.strip() for s in cell.split(sep) if s.strip()]
-                                        break
-                                if not examples_list and cell.strip():
-                                    examples_list = [cell.strip()]
-                        elif isinstance(cell, (list, tuple)):
-                            examples_list = [str(x) for x in cell]
-                codes.append(Code(code=code_text, description=desc_text, examples=examples_list))
-            return Codebook(codes=codes)
+            # Drop rows without a code label, then build each column in one vectorized pass
+            code_series = df[code_col].dropna().astype(str).str.strip()
+            code_series = code_series[code_series != ""]
+            rows = pd.DataFrame({"code": code_series})
+            if desc_col:
+                rows["description"] = df.loc[rows.index, desc_col].fillna("").astype(str).str.strip()
+            else:
+                rows["description"] = ""
+            if examples_col:
+                rows["examples"] = df.loc[rows.index, examples_col].map(_parse_examples_cell)
+            else:
+                rows["examples"] = [[] for _ in range(len(rows))]
+            return Codebook(codes=[Code(**record) for record in rows.to_dict("records")])
     except Exception as e:
         st.error(f"Failed to parse codebook: {e}")
     return None
@@ -241,29 +592,14 @@ def parse_uploaded_codebook(uploaded_file):
 # --- Helpers for robust merging ---
 def serialize_codebook_for_prompt(codebook_obj: Codebook) -> str:
     try:
-        payload = {
-            "codes": [
-                {
-                    "code": c.code,
-                    "description": c.description,
-                    "examples": c.examples or []
-                } for c in (codebook_obj.codes or [])
-            ]
-        }
-        return json.dumps(payload, indent=2)
+        return orjson.dumps(codebook_obj.model_dump(), option=orjson.OPT_INDENT_2).decode('utf-8')
     except Exception:
         # Fallback to pydantic dump
         return codebook_obj.model_dump_json(indent=2)
 
 def _extract_json_block(text: str) -> str:
-    try:
-        start = text.find('{')
-        end = text.rfind('}')
-        if start != -1 and end != -1 and end > start:
-            return text[start:end+1]
-    except Exception:
-        pass
-    return text
+    match = _JSON_BLOCK_RE.search(text)
+    return match.group(0) if match else text
 
 def merge_codebooks_via_llm(api_key: str, base_cb: Codebook, new_cb: Codebook, model: str, user_instructions: str):
     system_msg = "You are a master survey analyst."
@@ -282,7 +618,7 @@ def merge_codebooks_via_llm(api_key: str, base_cb: Codebook, new_cb: Codebook, m
         return None
     try:
         json_str = _extract_json_block(raw)
-        data = json.loads(json_str)
+        data = orjson.loads(json_str)
         return Codebook.model_validate(data)
     except Exception as e:
         st.error(f"Failed to parse merged codebook: {e}")
@@ -301,7 +637,7 @@ Current codebook JSON:\n{base_json}\n\nInstructions:\n{instructions}\n\nReturn O
         return None
     try:
         json_str = _extract_json_block(raw)
-        data = json.loads(json_str)
+        data = orjson.loads(json_str)
         return Codebook.model_validate(data)
     except Exception as e:
         st.error(f"Failed to parse refined codebook: {e}")
@@ -341,16 +677,7 @@ else:
     st.header("2. Configure Initial Coding Task")
     col_config_1, col_config_2 = st.columns(2)
     with col_config_1:
-        valid_columns = []
-        for col in df.columns:
-            try:
-                if pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]):
-                    series = df[col].dropna().astype(str).str.strip()
-                    unique_count = series[series != ""].nunique()
-                    if unique_count > 50:
-                        valid_columns.append(col)
-            except Exception:
-                continue
+        valid_columns = compute_valid_text_columns(df)
         if not valid_columns:
             st.warning("No text columns with > 50 unique non-empty values found.")
             st.stop()
@@ -374,7 +701,7 @@ else:
                 st.warning("Uploaded codebook is empty or invalid.")
     if st.button("✨ Generate Initial Codebook", use_container_width=True):
         st.session_state.initial_sample_size = num_examples
-        examples = df[column_to_code].dropna().unique().tolist()[:num_examples]
+        examples = get_unique_responses(df, column_to_code)[:num_examples]
         with st.spinner("AI is analyzing responses and generating your codebook..."):
             prompt = generate_structured_codebook_prompt(st.session_state.question_text, examples)
             codebook_object = call_ollama_api(st.session_state.api_key, "You are an expert survey analyst.", prompt, generation_model, pydantic_model=Codebook)
@@ -461,7 +788,7 @@ else:
             if st.button("🚀 Refine & Merge Codebook"):
                 with st.spinner("Refining and merging codebook..."):
                     initial_codebook = st.session_state.structured_codebook
-                    all_unique_responses = df[column_to_code].dropna().unique()
+                    all_unique_responses = get_unique_responses(df, column_to_code)
                     if len(all_unique_responses) == 0:
                         st.warning("No responses available to sample for refinement.")
                     else:
@@ -502,10 +829,8 @@ else:
             final_codebook_text = reconstruct_codebook_text(st.session_state.structured_codebook)
             if not final_codebook_text: st.error("Codebook is empty.")
             else:
-                #unique_responses = df[column_to_code].dropna().unique().tolist()
-
                 # 1. Get potentially mixed-type unique values
-                base_unique_responses = df[column_to_code].dropna().unique().tolist()
+                base_unique_responses = get_unique_responses(df, column_to_code)
                                 
                 # 2. Convert every item to a string first
                 string_responses = [str(item) for item in base_unique_responses]
@@ -513,91 +838,136 @@ else:
                 # 3. Now, safely filter out empty/whitespace strings
                 unique_responses = [text for text in string_responses if text.strip()]
 
+                # 4. Group exact duplicates modulo whitespace/case and classify one representative per group
+                canonical_groups = {}
+                for text in unique_responses: canonical_groups.setdefault(canonicalize_response(text), []).append(text)
+                unique_responses = [members[0] for members in canonical_groups.values()]
+
                 results_cache = {}
+                context = classification_context(st.session_state.question_text, final_codebook_text)
+
+                # 5. Reuse classifications stored by earlier runs with the same codebook, model and mode
+                cache_keys = classification_cache_keys(unique_responses, "multi" if use_multilabel else "single", classification_model, context)
+                cached = load_cached_classifications(list(cache_keys.values()))
+                for response, key in cache_keys.items():
+                    if key in cached: results_cache[response] = cached[key]
+                if results_cache:
+                    st.info(f"Reusing {len(results_cache)} cached classifications.")
+                    unique_responses = [response for response in unique_responses if response not in results_cache]
                 progress_bar = st.progress(0, text="Initializing classification...")
                 
                 # --- MODIFIED: The core classification loop now handles multi-label ---
                 def classify_item(response):
                     if use_multilabel:
-                        prompt = classify_response_prompt_multi(st.session_state.question_text, response, final_codebook_text)
-                        result = call_ollama_api(st.session_state.api_key, "You are a multi-label survey coding assistant.", prompt, model=classification_model, pydantic_model=ClassificationResult)
+                        prompt = classify_response_prompt_multi(response)
+                        result = call_ollama_api(st.session_state.api_key, "You are a multi-label survey coding assistant.", prompt, model=classification_model, pydantic_model=ClassificationResult, cache_prefix=context)
                         if result and result.assigned_codes:
                             return " | ".join(result.assigned_codes) # Join list into a string
                         return "No Code Applied" if result else "API_ERROR"
                     else: # Single-label path
-                        prompt = classify_response_prompt(st.session_state.question_text, response, final_codebook_text)
-                        return call_ollama_api(st.session_state.api_key, "You are a survey coding assistant.", prompt, model=classification_model) or "API_ERROR"
-
+                        prompt = classify_response_prompt(response)
+                        return call_ollama_api(st.session_state.api_key, "You are a survey coding assistant.", prompt, model=classification_model, cache_prefix=context) or "API_ERROR"
+
+                # Classifies a whole batch with one request; replies whose indices are not exactly 1..n fall back to classify_item
+                def classify_batch(responses: list[str]) -> list[str]:
+                    prompt = classify_batch_prompt(responses, use_multilabel)
+                    system_prompt = "You are a multi-label survey coding assistant." if use_multilabel else "You are a survey coding assistant."
+                    result = call_ollama_api(st.session_state.api_key, system_prompt, prompt, model=classification_model, pydantic_model=BatchClassificationResult, cache_prefix=context)
+                    codes_by_index = {item.index: item.assigned_codes for item in result.results} if result else {}
+                    # A reply numbered differently (e.g. from 0), with repeated or missing indices, would shift labels onto the wrong responses
+                    if result is None or len(result.results) != len(responses) or codes_by_index.keys() != set(range(1, len(responses) + 1)):
+                        return [classify_item(response) for response in responses]
+                    labels = []
+                    for i, response in enumerate(responses, 1):
+                        codes = codes_by_index[i]
+                        if not codes and not use_multilabel:
+                            labels.append(classify_item(response))
+                        elif use_multilabel:
+                            labels.append(" | ".join(codes) if codes else "No Code Applied")
+                        else:
+                            labels.append(codes[0])
+                    return labels
+
+                def classify_targets(targets, progress_start, progress_span, step_text):
+                    classified = {}
+                    batches = list(chunked(targets, CLASSIFICATION_BATCH_SIZE)); n_batches = len(batches)
+                    # Worker threads need the script run context to read session state and report errors
+                    ctx = get_script_run_ctx()
+                    with ThreadPoolExecutor(max_workers=MAX_CLASSIFICATION_WORKERS, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as executor:
+                        futures = {executor.submit(classify_batch, batch): batch for batch in batches}
+                        for batch_num, future in enumerate(as_completed(futures), 1):
+                            classified.update(zip(futures[future], future.result()))
+                            if batch_num % PROGRESS_UPDATE_EVERY == 0 or batch_num == n_batches:
+                                progress_bar.progress(progress_start + int(progress_span * batch_num / n_batches), text=f"{step_text} batch {batch_num}/{n_batches}...")
+                    return classified
+
+                embeddings = None
                 if use_clustering and len(unique_responses) > 1:
-                    # (Clustering logic remains the same, but now calls the unified classify_item function)
                     progress_bar.progress(5, text="Step 1/4: Generating embeddings..."); embeddings = get_embeddings(unique_responses)
-                    if not embeddings: st.error("Failed to generate embeddings."); st.stop()
-                    progress_bar.progress(15, text="Step 2/4: Clustering responses..."); embeddings = normalize(np.array(embeddings)); db = DBSCAN(eps=0.3, min_samples=2, metric='cosine').fit(embeddings); labels = db.labels_
+                if embeddings is not None:
+                    progress_bar.progress(15, text="Step 2/4: Clustering responses..."); embeddings = reduce_embeddings(embeddings); labels = attach_outliers_to_clusters(embeddings, cluster_embeddings(embeddings))
                     cluster_ids = set(labels); n_clusters = len(cluster_ids) - (1 if -1 in labels else 0); outliers = [response for response, label in zip(unique_responses, labels) if label == -1]; n_outliers = len(outliers)
                     total_api_calls = n_clusters + n_outliers
                     if total_api_calls == 0: st.info("No new responses to classify."); st.stop()
-                    st.info(f"Found {n_clusters} groups and {n_outliers} unique outliers. Total classifications needed: {total_api_calls}.")
-                    calls_made = 0; response_to_cluster = {response: label for response, label in zip(unique_responses, labels)}; classified_clusters = {}
-                    for cluster_id in cluster_ids:
-                        if cluster_id != -1:
-                            representative = next(response for response, label in response_to_cluster.items() if label == cluster_id)
-                            code_str = classify_item(representative) # Call unified function
-                            classified_clusters[cluster_id] = code_str; calls_made += 1
-                            progress_bar.progress(15 + int(70 * (calls_made / total_api_calls)), text=f"Step 3/4: Classifying group {calls_made}/{total_api_calls}...")
-                    for response in outliers:
-                        results_cache[response] = classify_item(response); calls_made += 1 # Call unified function
-                        progress_bar.progress(15 + int(70 * (calls_made / total_api_calls)), text=f"Step 3/4: Classifying outlier {calls_made}/{total_api_calls}...")
+                    st.info(f"Found {n_clusters} groups and {n_outliers} unique outliers. Total classifications needed: {total_api_calls}, sent in batches of {CLASSIFICATION_BATCH_SIZE}.")
+                    response_to_cluster = {response: label for response, label in zip(unique_responses, labels)}; representatives = {}
+                    for response, label in response_to_cluster.items():
+                        if label != -1: representatives.setdefault(label, response)
+                    classified = classify_targets(list(representatives.values()) + outliers, 15, 70, "Step 3/4: Classifying")
+                    classified_clusters = {cluster_id: classified[representative] for cluster_id, representative in representatives.items()}
+                    for response in outliers: results_cache[response] = classified[response]
                     for response, label in response_to_cluster.items():
                         if label != -1: results_cache[response] = classified_clusters[label]
                 else:
-                    for i, response in enumerate(unique_responses):
-                        results_cache[response] = classify_item(response) # Call unified function
-                        progress_bar.progress(int(100 * (i + 1) / len(unique_responses)), text=f"Classifying unique response {i+1}/{len(unique_responses)}...")
-                
-                progress_bar.progress(95, text="Step 4/4: Applying classifications..."); final_df = df.copy(); final_df['Assigned Code'] = final_df[column_to_code].map(results_cache); st.session_state.classified_df = final_df
+                    classified = classify_targets(unique_responses, 0, 90, "Classifying unique responses:")
+                    results_cache.update(classified)
+
+                # Persist only what the model labelled directly; codes propagated from a cluster stay out of the disk cache
+                store_cached_classifications({cache_keys[response]: code for response, code in classified.items() if code != "API_ERROR"})
+                for members in canonical_groups.values():
+                    for member in members[1:]: results_cache[member] = results_cache[members[0]]
+
+                progress_bar.progress(95, text="Step 4/4: Applying classifications...")
+                # Shallow copy: shares the uploaded columns' data, so only the new column is allocated
+                final_df = df.copy(deep=False)
+                # Factorize once, then gather each row's label from a per-unique-value lookup table.
+                # results_cache is keyed by the str() of each value; missing values factorize to -1 and pick the trailing None.
+                value_codes, uniques = pd.factorize(final_df[column_to_code], sort=False)
+                lookup = np.array([results_cache.get(str(value)) for value in uniques] + [None], dtype=object)
+                final_df['Assigned Code'] = lookup[value_codes]
+                # Few distinct labels repeated over many rows: categorical storage is far smaller and counts faster
+                if not use_multilabel: final_df['Assigned Code'] = final_df['Assigned Code'].astype('category')
+                st.session_state.classified_key = store_classified_df(final_df)
+                schedule_downloads(st.session_state.classified_key, final_df); get_nonnull_codes(st.session_state.classified_key, final_df)
+                st.session_state.display_cols = [c for c in (column_to_code, 'Assigned Code') if c in final_df.columns]
                 progress_bar.progress(100, text="Classification complete!"); st.success("Classification complete!")
 
-    if st.session_state.classified_df is not None:
+    classified_df = get_classified_df()
+    if classified_df is None and st.session_state.classified_key is not None:
+        # The process-wide store only keeps the latest MAX_STORED_RESULTS results, across all sessions
+        st.warning("Your classified results are no longer held in memory because newer results replaced them. Run the classification again to view and download them (cached classifications are reused).")
+    if classified_df is not None:
         st.divider()
         st.header("5. View and Download Results")
-        # Normalize separator to pipe for multi-label results (backward compatibility with older runs)
-        if 'Assigned Code' in st.session_state.classified_df.columns:
-            try:
-                series = st.session_state.classified_df['Assigned Code']
-                if pd.api.types.is_object_dtype(series):
-                    needs_conversion = series.fillna("").str.contains(",").any()
-                    if needs_conversion:
-                        st.session_state.classified_df['Assigned Code'] = series.fillna("").str.replace(r'\s*,\s*', ' | ', regex=True)
-            except Exception:
-                pass
-        # Only show the original coded column and the assigned code
-        col_to_show = st.session_state.get('column_to_code', None)
-        if not col_to_show:
-            try:
-                col_to_show = column_to_code
-            except Exception:
-                col_to_show = None
-        cols = []
-        if col_to_show and col_to_show in st.session_state.classified_df.columns:
-            cols.append(col_to_show)
-        if 'Assigned Code' in st.session_state.classified_df.columns:
-            cols.append('Assigned Code')
-        display_df = st.session_state.classified_df[cols] if cols else st.session_state.classified_df
-        st.dataframe(display_df)
+        # Only show the original coded column and the assigned code (resolved when classification finished)
+        display_df = classified_df.loc[:, st.session_state.display_cols or slice(None)]
+        # Only a bounded preview is sent to the browser; the downloads below contain every row
+        preview_rows = len(display_df)
+        if preview_rows > 100:
+            preview_rows = st.slider("Preview rows", 100, min(5000, len(display_df)), min(1000, len(display_df)))
+        st.dataframe(get_preview_table(st.session_state.classified_key, tuple(display_df.columns), preview_rows, display_df), use_container_width=True)
+        if preview_rows < len(display_df): st.caption(f"Showing the first {preview_rows:,} of {len(display_df):,} rows. Download the results for the full table.")
         
         # --- MODIFIED: Frequency table now handles multi-label results ---
         st.subheader("Code Frequencies")
-        freq_df = st.session_state.classified_df['Assigned Code'].dropna()
-        # Check if we need to split multi-label strings
-        if use_multilabel:
-            # Split pipe-separated strings into lists, then create a new row for each code
-            freq_df = freq_df.str.split(r'\s*\|\s*').explode()
-        
-        freq_counts = freq_df.value_counts().reset_index()
-        freq_counts.columns = ['Code', 'Frequency']
-        freq_counts['Percentage'] = (freq_counts['Frequency'] / freq_counts['Frequency'].sum()).map('{:.2%}'.format)
-        st.dataframe(freq_counts, use_container_width=True)
+        freq_counts = compute_code_frequencies(get_nonnull_codes(st.session_state.classified_key, classified_df), use_multilabel)
+        st.dataframe(freq_counts, use_container_width=True, column_config={'Percentage': st.column_config.NumberColumn(format="%.2f%%")})
 
         d_col1, d_col2 = st.columns(2)
-        d_col1.download_button("📥 Download as CSV", convert_df_to_downloadable(st.session_state.classified_df, "CSV"), "classified_data.csv", "text/csv", use_container_width=True)
-        d_col2.download_button("📥 Download as Excel", convert_df_to_downloadable(st.session_state.classified_df, "Excel"), "classified_data.xlsx", use_container_width=True)
\ No newline at end of file
+        d_col1.download_button("📥 Download as CSV", get_download_bytes(st.session_state.classified_key, "CSV", classified_df), "classified_data.csv", "text/csv", use_container_width=True)
+        try:
+            excel_bytes = get_download_bytes(st.session_state.classified_key, "Excel", classified_df)
+        except ValueError as e:  # More rows than an Excel sheet holds
+            d_col2.warning(f"Excel download unavailable: {e}. Use the CSV download instead.")
+        else:
+            d_col2.download_button("📥 Download as Excel", excel_bytes, "classified_data.xlsx", use_container_width=True)
\ No newline at end of file